@@ -1,6 +1,11 @@
 from collections import defaultdict
+import cProfile
+import hmac
 import json
 import os
+import pstats
+import re
+import uuid
 from functools import wraps
 from time import time
 
@@ -20,6 +25,23 @@ app = flask.Flask(__name__)
 SCOPE_USEREMAIL = "userinfo.email"
 SCOPE_DRIVE = "drive"
 
+# Term whose Locker_Rentals partition is served to students and admins;
+#  older terms stay in the sheet but are never indexed or cached.
+# Each term has its own rental form, so ECESS_LOCKER_FORM_URL must be
+#  changed together with ECESS_CURRENT_TERM; its responses are read from
+#  LOCKER_FORM.
+CURRENT_TERM = os.getenv("ECESS_CURRENT_TERM", "2015W1")
+LOCKER_FORM = "[ECESS] MCLD Locker Rental {} (Responses)".format(CURRENT_TERM)
+LOCKER_FORM_URL = os.getenv(
+    "ECESS_LOCKER_FORM_URL",
+    "https://docs.google.com/forms/d/"
+    "1ixLqNKOggJqdasJ1u5QgQQA9bpLXpKO8F9XIHDKwy-0/"
+    "viewform?entry.1882898146={google_email}"
+)
+
+# Seconds a student's locker status may lag edits to Locker_Rentals
+RENTAL_STATUS_CACHE_PERIOD = 30
+
 TYPE_USER = "user"
 TYPE_EDITOR = "editor"
 
@@ -143,6 +165,48 @@ def sheet2lod(sheet):
     keys = sheet.row_values(1)
     return [dict(zip(keys, entry)) for entry in sheet.get_all_values()[1:]]
 
+
+def sheet2partitions(sheet, partition_key, partitions=None):
+    """Groups rows of sheet into lists of dicts keyed by partition_key
+
+    :param partitions: If given, only rows whose partition_key value is
+        in partitions are kept; all other rows are dropped without
+        building dicts for them.
+    """
+    keys = sheet.row_values(1)
+    if partition_key not in keys:
+        raise KeyError("{} does not exist in {}".format(partition_key,
+                                                        sheet.title))
+    pk_idx = keys.index(partition_key)
+    d = defaultdict(list)
+    for entry in sheet.get_all_values()[1:]:
+        pk_val = entry[pk_idx]
+        if partitions is None or pk_val in partitions:
+            d[pk_val].append(dict(zip(keys, entry)))
+    return d
+
+
+class RentalPartition(object):
+    """Locker_Rentals entries for a single Term
+
+    Indexed by (lowercased) Google_Email and by Locker_Number; both
+    indexes map to lists of entries in sheet order.
+    """
+    def __init__(self, term, entries):
+        self.term = term
+        self.entries = entries
+        self.by_email = defaultdict(list)
+        self.by_locker_number = defaultdict(list)
+        for entry in entries:
+            self.by_email[entry["Google_Email"].lower()].append(entry)
+            if entry["Locker_Number"]:
+                self.by_locker_number[entry["Locker_Number"]].append(entry)
+
+    @classmethod
+    def from_sheet(cls, sheet, term=CURRENT_TERM):
+        entries = sheet2partitions(sheet, "Term", partitions={term})[term]
+        return cls(term, entries)
+
 def _get_service(api, version, credentials):
     http_auth = credentials.authorize(httplib2.Http())
     service = discovery.build(api, version, http_auth)
@@ -195,31 +259,22 @@ def _wkskeys(wks):
 def _get_free_lockers():
     lockers = get_spreadsheet_fromsvc("Lockers", cache_period=120)
     lockers_keys = _wkskeys(lockers)
-    locker_sales = get_spreadsheet_fromsvc("Locker_Rentals", cache_period=30)
-    locker_sales_keys = _wkskeys(locker_sales)
+    # _cache_free_lockers already caches the result
+    locker_sales = _cache_rental_partition(cache_period=0)
 
     rentable = {entry[lockers_keys["Number"]] for entry in
                 lockers.get_all_values()[1:]
                 if entry[lockers_keys["Type"]] == "Rentable"}
     all_rentable = rentable.copy()
-    used_locker_numbers = set()
     doubly_used = []
     invalid_entries = []
 
-    for entry in locker_sales.get_all_values()[1:]:
-        locker_number = entry[locker_sales_keys["Locker_Number"]]
-
-        if locker_number in used_locker_numbers:
-            doubly_used.append(entry)
-        elif locker_number and locker_number not in all_rentable:
-            invalid_entries.append(entry)
-
-        if (
-            locker_number in rentable and
-            entry[locker_sales_keys["Locker_Number"]] != "Yes"
-        ):
-            rentable.remove(locker_number)
-            used_locker_numbers.add(locker_number)
+    for locker_number, entries in locker_sales.by_locker_number.items():
+        if locker_number not in all_rentable:
+            invalid_entries.extend(entries)
+            continue
+        rentable.discard(locker_number)
+        doubly_used.extend(entries[1:])
 
     res = list(sorted(rentable, key=lambda x: int(x)))
     res.extend([
@@ -235,6 +290,27 @@ def _get_free_lockers():
     return "\n<br>".join(map(str, res))
 
 
+def _cache_rental_partition(term=CURRENT_TERM, cache_period=30):
+    """Returns the RentalPartition for term, fetched with service
+    credentials and cached for cache_period
+
+    Pages served from this cache can lag edits made to Locker_Rentals
+    by up to cache_period seconds. Callers that already cache their own
+    result should pass cache_period=0 so the two periods don't add up.
+    """
+    top = flask._app_ctx_stack
+    if not hasattr(top, 'rental_partitions'):
+        top.rental_partitions = {}
+
+    cached = top.rental_partitions.get(term)
+    if cached is None or time() - cached[0] > cache_period:
+        wks = get_spreadsheet_fromsvc("Locker_Rentals")
+        top.rental_partitions[term] = time(), RentalPartition.from_sheet(
+            wks, term)
+
+    return top.rental_partitions[term][1]
+
+
 def _cache_free_lockers(cache_period=30):
     top = flask._app_ctx_stack
     if not hasattr(top, 'free_lockers'):
@@ -319,17 +395,14 @@ def rentalocker(credentials):
         return not_registered
 
     # Check if they have a locker sales entry
-    wks = get_spreadsheet_fromsvc("[ECESS] MCLD Locker Rental 2015W1 (Responses)")
+    wks = get_spreadsheet_fromsvc(LOCKER_FORM)
     locker_form_keys = {v: k for k, v in enumerate(wks.row_values(1))}
     for locker_form_entry in wks.get_all_values()[1:]:
         if locker_form_entry[locker_form_keys["Google_Email"]].lower() == google_email.lower():
             payment_type = locker_form_entry[locker_form_keys["Payment_Method"]]
             break
     else:
-        FORM_URL = "https://docs.google.com/forms/d/" \
-               "1ixLqNKOggJqdasJ1u5QgQQA9bpLXpKO8F9XIHDKwy-0/" \
-               "viewform?entry.1882898146={google_email}"
-        return flask.redirect(FORM_URL.format(google_email=google_email))
+        return flask.redirect(LOCKER_FORM_URL.format(google_email=google_email))
 
     # Present their status
     res = [
@@ -337,39 +410,36 @@ def rentalocker(credentials):
         "",
         "Step 1 (Rental Request Form): Complete! We have received your form."
     ]
-    wks = get_spreadsheet_fromsvc("Locker_Rentals")
-    keys = {v: k for k, v in enumerate(wks.row_values(1))}
-    for entry in wks.get_all_values()[1:]:
-        if (
-            entry[keys["Google_Email"]] == google_email and
-            entry[keys["Term"]] == "2015W1"
-        ):
-            payment_status = entry[keys["Paid"]]
-            if payment_status == "Not_Paid":
-                if payment_type == "Cash":
-                    res.append("Step 2 (Payment): Waiting for your payment; please"
-                               " visit MCLD 434 to pay with cash! Cost is"
-                               " $11.")
-                elif payment_type == "PayPal_Invoice":
-                    res.append("Step 2 (Payment): We need to send you a PayPal Invoice; "
-                               "you should receive it soon so that you "
-                               "are able to pay for your locker.")
-            elif payment_status == "Invoice_Sent":
-                res.append("Step 2 (Payment): A PayPal Invoice has been sent to your "
-                           " email. Please promptly pay this invoice so that"
-                           " we can assign you a locker number.")
-            elif payment_status == "Payment_Received":
-                res.append("Step 2 (Payment): We have successfully received your "
-                           "payment!")
-                locker_number = entry[keys["Locker_Number"]]
-                if locker_number:
-                    res.append("Step 3 (Locker Assignment): Your locker has been assigned. Your locker"
-                               " is #{}".format(locker_number))
-                else:
-                    res.append("Step 3 (Locker Assignment): We have not yet determined your locker "
-                               "number. Please check back in a bit!")
+    rentals = _cache_rental_partition(
+        cache_period=RENTAL_STATUS_CACHE_PERIOD
+    ).by_email.get(google_email.lower(), [])
+    for entry in rentals:
+        payment_status = entry["Paid"]
+        if payment_status == "Not_Paid":
+            if payment_type == "Cash":
+                res.append("Step 2 (Payment): Waiting for your payment; please"
+                           " visit MCLD 434 to pay with cash! Cost is"
+                           " $11.")
+            elif payment_type == "PayPal_Invoice":
+                res.append("Step 2 (Payment): We need to send you a PayPal Invoice; "
+                           "you should receive it soon so that you "
+                           "are able to pay for your locker.")
+        elif payment_status == "Invoice_Sent":
+            res.append("Step 2 (Payment): A PayPal Invoice has been sent to your "
+                       " email. Please promptly pay this invoice so that"
+                       " we can assign you a locker number.")
+        elif payment_status == "Payment_Received":
+            res.append("Step 2 (Payment): We have successfully received your "
+                       "payment!")
+            locker_number = entry["Locker_Number"]
+            if locker_number:
+                res.append("Step 3 (Locker Assignment): Your locker has been assigned. Your locker"
+                           " is #{}".format(locker_number))
+            else:
+                res.append("Step 3 (Locker Assignment): We have not yet determined your locker "
+                           "number. Please check back in a bit!")
 
-            return "\n<br>".join(res)
+        return "\n<br>".join(res)
     else:
         res.append("Step 1a: We have received your locker rental request. If"
                    " there are any available lockers for you, we'll try "
@@ -437,12 +507,12 @@ def _admin_seattle_review(credentials, spreadsheet="Seattle Trip 2015 Sign-Up (R
 def invoices_to_send(credentials):
     gc = get_drive_conn(credentials)
     try:
-        locker_rentals = sheet2lod(get_spreadsheet_fromusr(
+        locker_rentals = RentalPartition.from_sheet(get_spreadsheet_fromusr(
             "Locker_Rentals",
             gc=gc
-        ))
+        )).entries
         locker_form = sheet2dict(get_spreadsheet_fromusr(
-            "[ECESS] MCLD Locker Rental 2015W1 (Responses)",
+            LOCKER_FORM,
             gc=gc
         ), "Google_Email")
         contact_form = sheet2dict(get_spreadsheet_fromusr(
@@ -475,15 +545,12 @@ def invoices_to_send(credentials):
 def locker_queue(credentials):
     gc = get_drive_conn(credentials)
     try:
-        _locker_rentals = sheet2lod(get_spreadsheet_fromusr(
+        locker_rentals = RentalPartition.from_sheet(get_spreadsheet_fromusr(
             "Locker_Rentals",
             gc=gc
-        ))
-        locker_rentals = defaultdict(list)
-        for lr in _locker_rentals:
-            locker_rentals[lr["Google_Email"].lower()].append(lr)
+        )).by_email
         locker_form = sheet2lod(get_spreadsheet_fromusr(
-            "[ECESS] MCLD Locker Rental 2015W1 (Responses)",
+            LOCKER_FORM,
             gc=gc
         ))
         contact_form = sheet2dict(get_spreadsheet_fromusr(
@@ -509,7 +576,6 @@ def locker_queue(credentials):
         except KeyError:
             email = None
         dln = entry["Desired_Locker_Number"]
-        # TODO XXX Handle multiple terms
         if gmail not in locker_rentals:
             contact_user = contact_form.get(gmail)
             if contact_user is None:
@@ -557,10 +623,10 @@ def locker_queue(credentials):
 def locker_tenants(credentials):
     gc = get_drive_conn(credentials)
     try:
-        _locker_rentals = sheet2lod(get_spreadsheet_fromusr(
+        _locker_rentals = RentalPartition.from_sheet(get_spreadsheet_fromusr(
             "Locker_Rentals",
             gc=gc
-        ))
+        )).entries
         contact_form = sheet2dict(get_spreadsheet_fromusr(
             "ECESS 2015W Student Contact Form (Responses)",
             gc=gc
@@ -645,13 +711,123 @@ class ReverseProxied(object):
         return self.app(environ, start_response)
 
 
-if __name__ == '__main__':
-    import uuid
+class RequestProfiler(object):
+    '''Wrap the application in this middleware to run individual requests
+    under cProfile for diagnosing slow pages in production.
+
+    Profiling is only enabled when a token is configured, and only
+    for requests that send it in the X-Profile header, so hand it out to
+    editors only. The session can't be used for this: authenticated()
+    adds TYPE_EDITOR to the session's usertypes before any
+    authorization happens, so it proves nothing. The profile is dumped to profile_dir (open it with
+    pstats or snakeviz) and a summary of time spent waiting on upstream
+    (Google API/Sheets) sockets versus Python compute is logged and
+    returned in the X-Profile-Summary response header.
 
+    Every other request only pays for one environ lookup.
+
+    :param app: the WSGI application
+    :param token: Shared secret; profiling is disabled if this is empty
+    :param profile_dir: Directory to save .prof files to
+    '''
+    # Stdlib modules doing upstream I/O, matched on the end of the path
+    UPSTREAM_MODULES = ("/socket.py", "/ssl.py", "/http/client.py",
+                        "/httplib.py")
+    # C socket methods, which cProfile reports with filename "~"
+    UPSTREAM_BUILTINS = re.compile(
+        r"^<(method '\w+' of '(_socket\.socket|_ssl\._SSLSocket)' objects"
+        r"|built-in method _socket\.\w+)>$"
+    )
+    MAX_PATH_CHARS = 100
+
+    def __init__(self, app, token, profile_dir="profiles"):
+        self.app = app
+        self.token = token
+        self.profile_dir = profile_dir
+
+    def __call__(self, environ, start_response):
+        if not self.token or not self._token_matches(environ):
+            return self.app(environ, start_response)
+
+        captured = []
+        body = []
+
+        def capture_start_response(status, headers, exc_info=None):
+            captured[:] = [status, headers, exc_info]
+            return lambda data: body.append(data)
+
+        summary = None
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            app_iter = self.app(environ, capture_start_response)
+            try:
+                body.extend(app_iter)
+            finally:
+                if hasattr(app_iter, 'close'):
+                    app_iter.close()
+        finally:
+            # Also runs when the app raises, so failing requests (e.g. a
+            #  Sheets timeout with PROPAGATE_EXCEPTIONS) still get profiled
+            profiler.disable()
+            try:
+                summary = self._summarize(profiler,
+                                          environ.get('PATH_INFO', ''))
+                print("Profile {}".format(summary))
+            except Exception as e:
+                print("Profile could not be saved: {}".format(e))
+
+        if not captured:  # App never called start_response
+            return body
+        status, headers, exc_info = captured
+        if summary is not None:
+            headers = headers + [("X-Profile-Summary", summary)]
+        start_response(status, headers, exc_info)
+        return body
+
+    def _token_matches(self, environ):
+        try:
+            return hmac.compare_digest(environ.get('HTTP_X_PROFILE', ''),
+                                       self.token)
+        except TypeError:  # Non-ASCII header value
+            return False
+
+    def _is_upstream(self, filename, funcname):
+        if filename == "~":
+            return self.UPSTREAM_BUILTINS.match(funcname) is not None
+        return filename.replace(os.sep, "/").endswith(self.UPSTREAM_MODULES)
+
+    def _summarize(self, profiler, path):
+        if not os.path.isdir(self.profile_dir):
+            os.makedirs(self.profile_dir)
+        fname = os.path.join(self.profile_dir, "{}-{}-{}.prof".format(
+            arrow.utcnow().format("YYYYMMDD-HHmmss"),
+            re.sub(r"[^\w.-]", "_", path)[:self.MAX_PATH_CHARS],
+            uuid.uuid4().hex
+        ))
+        profiler.dump_stats(fname)
+
+        stats = pstats.Stats(profiler)
+        upstream = 0.0
+        for (filename, _, funcname), (_, _, tt, _, _) in stats.stats.items():
+            if self._is_upstream(filename, funcname):
+                upstream += tt
+        # repr() escapes control characters so PATH_INFO can't split the
+        #  header or the log line
+        return "path={!r} total={:.3f}s upstream={:.3f}s compute={:.3f}s " \
+               "file={}".format(path[:self.MAX_PATH_CHARS], stats.total_tt,
+                                upstream, stats.total_tt - upstream, fname)
+
+
+if __name__ == '__main__':
     app.secret_key = str(uuid.uuid4())
     app.debug = os.getenv("FLASK_DEBUG") == "1"
     if app.debug:
         print("WARNING: DEBUG MODE IS ENABLED!")
     app.config["PROPAGATE_EXCEPTIONS"] = True
-    app.wsgi_app = ReverseProxied(app.wsgi_app)
+    app.wsgi_app = ReverseProxied(RequestProfiler(
+        app.wsgi_app,
+        token=os.getenv("ECESS_PROFILE_TOKEN"),
+        profile_dir=os.getenv("ECESS_PROFILE_DIR", "profiles")
+    ))
     app.run(threaded=True)